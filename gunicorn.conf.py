@@ -0,0 +1,24 @@
+# gunicorn -c gunicorn.conf.py server:app
+#
+# One worker only: the camera, the model and the frame buffers live in the
+# server process.
+#
+# Capacity: every open MJPEG stream (/video_feed, /video_feed_raw) holds one
+# worker thread for as long as it is watched. Once all threads are taken, any
+# further request -- including /, /static/* and /sensor_data -- queues until
+# a stream closes. Size GUNICORN_THREADS for the expected viewers plus a few
+# for page loads and sensor polls. This gives a bounded thread pool, not
+# more viewers than `python server.py` (threaded Werkzeug) can serve.
+import os
+
+bind = "0.0.0.0:5000"
+workers = 1
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "32"))
+timeout = 0  # MJPEG responses never complete
+
+
+def post_worker_init(worker):
+    # `python server.py` starts these in __main__; under gunicorn do it here
+    import server
+    server.start_threads()
@@ -1,39 +1,104 @@
 #!/usr/bin/env python3
 import os
+import math
 import time
+import ctypes
+import ctypes.util
+import hashlib
 import threading
 import platform
 import requests
 
 import cv2
-from flask import Flask, Response, jsonify, request, send_from_directory
+import numpy as np
+import torch
+import torch.nn.functional as F
+from flask import Flask, Response, request, send_from_directory
 from ultralytics import YOLO
+from ultralytics.engine.results import Results
+from ultralytics.utils import ops
 
-# Optional fast JPEG encoder
+# One OpenCV thread per call: on <1 MP frames waking the pool costs more than
+# it saves, and the capture/YOLO/Flask threads already call OpenCV in parallel
+cv2.setNumThreads(1)
+
+# Fast JPEG encoder (libjpeg-turbo); required for MJPEG streaming
 try:
-    from turbojpeg import TurboJPEG
+    from turbojpeg import TurboJPEG, TJPF_BGR, TJSAMP_420, TJFLAG_FASTDCT
     jpeg = TurboJPEG()
+except Exception as e:
+    raise RuntimeError(
+        f"[ERROR] TurboJPEG unavailable ({e}). Install libjpeg-turbo and PyTurboJPEG."
+    )
+
+# libturbojpeg's C API directly, so each thread can compress into a buffer it
+# reuses (TJFLAG_NOREALLOC); PyTurboJPEG allocates a new one per frame
+TJFLAG_NOREALLOC = 1024
+try:
+    tj = ctypes.CDLL(ctypes.util.find_library("turbojpeg") or "libturbojpeg.so.0")
+    tj.tjInitCompress.restype = ctypes.c_void_p
+    tj.tjDestroy.argtypes = [ctypes.c_void_p]
+    tj.tjBufSize.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int]
+    tj.tjBufSize.restype = ctypes.c_ulong
+    tj.tjCompress2.argtypes = [
+        ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+        ctypes.c_int, ctypes.POINTER(ctypes.POINTER(ctypes.c_ubyte)),
+        ctypes.POINTER(ctypes.c_ulong), ctypes.c_int, ctypes.c_int, ctypes.c_int,
+    ]
 except Exception:
-    jpeg = None
+    tj = None
+tj_local = threading.local()  # per-thread JpegEncoder
+
+# Optional Triton for the fused GPU preprocessing kernel
+try:
+    import triton
+    import triton.language as tl
+    HAVE_TRITON = True
+except ImportError:
+    HAVE_TRITON = False
+
+# Optional fast JSON encoder
+try:
+    import orjson
+    json_dumps = orjson.dumps
+except ImportError:
+    import json
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
 
 # ----------------------------
 # Config
 # ----------------------------
 MODEL_PATH = "fire_smoke_yolo11s_50epochs.pt"
 CAM_INDEX = 2
-BACKEND = cv2.CAP_DSHOW if platform.system() == "Windows" else cv2.CAP_ANY
+if platform.system() == "Windows":
+    BACKEND = cv2.CAP_DSHOW
+elif platform.system() == "Linux":
+    BACKEND = cv2.CAP_V4L2  # supports handing out raw YUYV (see RAW_YUYV)
+else:
+    BACKEND = cv2.CAP_ANY
 
 IMG_MAX_WIDTH = 960     # will auto-reduce on CPU (see below)
 CONF = 0.25
-TARGET_INF_FPS = 30
+MAX_DET = 50
+TARGET_INF_FPS = 30     # may auto-reduce on CPU (see below)
 STREAM_FPS = 30
 JPEG_QUALITY = 70
-FRAME_SKIP = 2          # may auto-increase on CPU (see below)
+BATCH = 4               # frames per forward pass; forced to 1 on CPU (see below)
 USE_CUDA = os.environ.get("USE_CUDA", "1") == "1"  # set to 0 to force CPU
+USE_TRT = os.environ.get("USE_TRT", "1") == "1"    # set to 0 to run the .pt on GPU
+USE_COMPILE = os.environ.get("USE_COMPILE", "1") == "1"  # torch.compile on CPU
+# On GPU, take YUYV straight from the camera and convert it on the device
+RAW_YUYV = os.environ.get("RAW_YUYV", "1") == "1"
+# Dataset yaml (~200 representative frames) for INT8 calibration. When set,
+# the GPU builds an INT8 TensorRT engine and the CPU runs OpenVINO INT8.
+INT8_DATA = os.environ.get("INT8_DATA", "")
 
 # ThingSpeak settings
 CHANNEL_ID = "3131292"
-TS_URL = f"https://api.thingspeak.com/channels/{CHANNEL_ID}/fields/{{}}.json?results=1"
+TS_URL = f"https://api.thingspeak.com/channels/{CHANNEL_ID}/feeds.json?results=1"
+TS_FIELDS = (1, 2, 3)
+TS_POLL_INTERVAL = 5    # seconds
 
 # ----------------------------
 # Init
@@ -45,51 +110,157 @@ WEB_DIR = os.path.join(BASE_DIR, "web")
 # Serve /static/* from the web folder
 app = Flask(__name__, static_folder=WEB_DIR, static_url_path="/static")
 
-print(f"[INFO] Loading YOLO model: {MODEL_PATH}")
-model = YOLO(MODEL_PATH)
-
 # Decide device (GPU if available and allowed, else CPU)
 GPU = False
 try:
-    import torch
     gpu_available = torch.cuda.is_available()
     if USE_CUDA and gpu_available:
-        model.to("cuda")
         GPU = True
         # Optional small speedup for constant resolution inputs
         torch.backends.cudnn.benchmark = True
         print("[INFO] Using GPU (CUDA)")
     else:
-        model.to("cpu")
         print("[INFO] Using CPU")
-        # Optional: let torch use many threads
+        # Let torch use all but two cores (left for capture, OpenCV and
+        # Flask); override with CPU_THREADS
         try:
-            threads = int(os.environ.get("CPU_THREADS", "0"))
+            default_threads = max(1, (os.cpu_count() or 1) - 2)
+            threads = int(os.environ.get("CPU_THREADS", default_threads))
             if threads > 0:
                 torch.set_num_threads(threads)
                 print(f"[INFO] torch.set_num_threads({threads})")
         except Exception:
             pass
 except Exception as e:
-    # If torch is not present for some reason, Ultralytics would fail earlier,
-    # but keep a helpful message.
+    # Keep a helpful message if the CUDA check itself fails.
     print(f"[WARN] Torch check failed ({e}). Continuing; model will default to CPU.")
 
-# Slight speed-up
-try:
-    model.fuse()
-except Exception:
-    pass
-
 # Auto-tune for CPU to keep FPS reasonable
 if not GPU:
     # If you want to force different values, set them via env vars before running.
     if IMG_MAX_WIDTH and IMG_MAX_WIDTH > 640:
         print(f"[INFO] CPU detected: reducing IMG_MAX_WIDTH {IMG_MAX_WIDTH} -> 640")
         IMG_MAX_WIDTH = 640
-    if FRAME_SKIP < 2:
-        print(f"[INFO] CPU detected: increasing FRAME_SKIP {FRAME_SKIP} -> 2")
-        FRAME_SKIP = 2
+    if TARGET_INF_FPS > 15:
+        print(f"[INFO] CPU detected: reducing TARGET_INF_FPS {TARGET_INF_FPS} -> 15")
+        TARGET_INF_FPS = 15
+    if BATCH > 1:
+        print(f"[INFO] CPU detected: reducing BATCH {BATCH} -> 1")
+        BATCH = 1
+
+def calib_tag(data):
+    # Short id of the INT8 calibration set: its yaml path and contents. Images
+    # swapped behind an unchanged yaml are not detected; delete the model then.
+    h = hashlib.sha1(os.path.abspath(data).encode())
+    try:
+        with open(data, "rb") as f:
+            h.update(f.read())
+    except OSError:
+        pass
+    return h.hexdigest()[:8]
+
+# Exported models are built once from MODEL_PATH. Everything that shapes the
+# build is in the name, so changing BATCH, IMG_MAX_WIDTH or the INT8_DATA yaml
+# exports a new model instead of loading a mismatched one.
+MODEL_STEM = os.path.splitext(MODEL_PATH)[0]
+PRECISION = f"int8-{calib_tag(INT8_DATA)}" if INT8_DATA else "fp16"
+ENGINE_PATH = f"{MODEL_STEM}_{PRECISION}_{IMG_MAX_WIDTH}_dyn-b{BATCH}.engine"
+OPENVINO_PATH = f"{MODEL_STEM}_{PRECISION}_{IMG_MAX_WIDTH}_openvino_model"
+
+def export_once(path, **kwargs):
+    # Export MODEL_PATH unless `path` exists; Ultralytics names the output
+    # after the checkpoint, so move it to its build-specific `path`
+    if not os.path.exists(path):
+        print(f"[INFO] Exporting {kwargs['format']} model: {path} (one-time, takes a few minutes)")
+        out = YOLO(MODEL_PATH).export(**kwargs)
+        if os.path.abspath(out) != os.path.abspath(path):
+            os.replace(out, path)
+    return path
+
+# On GPU, prefer a TensorRT engine (fused layers, tensor-core kernels), FP16
+# or INT8-calibrated. On CPU with INT8_DATA, use OpenVINO INT8 (VNNI kernels).
+# Exported models are device-fixed, so no .to()/.fuse() on those paths.
+TRT = False
+OPENVINO = False
+if GPU and USE_TRT:
+    try:
+        export_once(
+            ENGINE_PATH,
+            format="engine",
+            half=not INT8_DATA,
+            int8=bool(INT8_DATA),
+            data=INT8_DATA or None,
+            imgsz=IMG_MAX_WIDTH,
+            dynamic=True,   # lets TensorRT accept 1..BATCH frames
+            batch=BATCH,
+            workspace=4,
+        )
+        print(f"[INFO] Loading TensorRT engine: {ENGINE_PATH}")
+        model = YOLO(ENGINE_PATH, task="detect")
+        TRT = True
+    except Exception as e:
+        print(f"[WARN] TensorRT unavailable ({e}). Falling back to PyTorch.")
+elif not GPU and INT8_DATA:
+    try:
+        export_once(
+            OPENVINO_PATH,
+            format="openvino",
+            int8=True,
+            data=INT8_DATA,
+            imgsz=IMG_MAX_WIDTH,
+        )
+        print(f"[INFO] Loading OpenVINO INT8 model: {OPENVINO_PATH}")
+        model = YOLO(OPENVINO_PATH, task="detect")
+        OPENVINO = True
+    except Exception as e:
+        print(f"[WARN] OpenVINO unavailable ({e}). Falling back to PyTorch.")
+
+if not TRT and not OPENVINO:
+    print(f"[INFO] Loading YOLO model: {MODEL_PATH}")
+    model = YOLO(MODEL_PATH)
+    model.to("cuda" if GPU else "cpu")
+
+    # Slight speed-up
+    try:
+        model.fuse()
+    except Exception:
+        pass
+
+    # NHWC lets cuDNN pick tensor-core conv kernels for FP16 inputs
+    if GPU:
+        model.model.to(memory_format=torch.channels_last)
+
+def warmup(n=1):
+    for _ in range(n):
+        model.predict(
+            np.zeros((480, 640, 3), np.uint8),
+            conf=CONF,
+            imgsz=IMG_MAX_WIDTH if IMG_MAX_WIDTH else None,
+            half=GPU,
+            verbose=False,
+            max_det=MAX_DET,
+        )
+
+# Build the predictor once so yolo_loop can call its inference() directly
+warmup()
+
+# On the CPU fallback, compile the network Ultralytics actually runs (the
+# predictor's copy; compiling model.model before predict() would be undone
+# by its fuse()). Compile errors only surface on the first call, so warm up
+# here and keep eager mode if that fails.
+if not GPU and not OPENVINO and USE_COMPILE and hasattr(torch, "compile"):
+    eager = model.predictor.model.model
+    try:
+        eager.eval()
+        model.predictor.model.model = torch.compile(
+            eager, mode="reduce-overhead", fullgraph=False
+        )
+        with torch.inference_mode():
+            warmup(3)
+        print("[INFO] torch.compile enabled")
+    except Exception as e:
+        model.predictor.model.model = eager
+        print(f"[WARN] torch.compile failed ({e}). Using eager PyTorch.")
 
 # ----------------------------
 # Camera setup
@@ -107,122 +278,493 @@ try:
 except Exception:
     pass
 
+# Skip the driver-side YUYV->BGR convert when the GPU does it anyway. Only
+# if the camera really switched to YUYV: raw MJPG would be compressed bytes.
+YUYV = False
+if GPU and RAW_YUYV and BACKEND == cv2.CAP_V4L2:
+    fourcc = cv2.VideoWriter_fourcc(*"YUYV")
+    try:
+        cap.set(cv2.CAP_PROP_FOURCC, fourcc)
+        if int(cap.get(cv2.CAP_PROP_FOURCC)) == fourcc:
+            YUYV = bool(cap.set(cv2.CAP_PROP_CONVERT_RGB, 0))
+    except Exception:
+        pass
+    if YUYV:
+        print("[INFO] Capturing raw YUYV; colour conversion runs on the GPU")
+CAP_W = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+CAP_H = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
 # Shared state
-lock = threading.Lock()
-latest_raw = None
-latest_annot = None
+# Frames live in fixed, reused buffers. Each stream has a single writer that
+# fills a slot nobody is reading and then publishes it by bumping a sequence
+# number; the newest frame is bufs[(seq - 1) % slots]. Plain int assignment
+# is atomic under the GIL, so readers need no lock and use the slot in place.
+# Writers notify_all() on the stream's condition so every waiting reader
+# (YOLO, each MJPEG viewer) wakes on a new frame instead of sleep-polling.
+# Capture ring: BATCH + 2 deep so the frames YOLO takes are not overwritten
+# before they are copied out (on GPU into the pinned upload slot by
+# stage_frames, on CPU into a private copy); later stages never read it.
+RAW_SLOTS = BATCH + 2
+raw_bufs = [None] * RAW_SLOTS
+raw_seq = 0
+raw_ready = threading.Condition()
+# Annotated triple buffer
+annot_bufs = [None] * 3
+annot_seq = 0
+annot_ready = threading.Condition()
+# Open /video_feed responses; annotation is skipped while this is 0
+annot_viewers = 0
+viewers_lock = threading.Lock()
+# Two rotating upload slots (page-locked host + device) so the copy of batch
+# N+1 on copy_stream overlaps inference of batch N on compute_stream.
+pinned_bufs = [None, None]
+device_bufs = [None, None]
+copy_stream = torch.cuda.Stream() if GPU else None
+compute_stream = torch.cuda.Stream() if GPU else None
+# Latest ThingSpeak values as ready-to-send JSON, refreshed by sensor_loop
+sensor_json = json_dumps({f"field{n}": 0.0 for n in TS_FIELDS})
 stop_flag = False
 
+# Box colours (BGR) indexed by class id, and per-class label strips rendered once
+COLORS = np.array([
+    (0, 0, 255), (160, 160, 160), (0, 165, 255),
+    (255, 0, 0), (0, 255, 0), (255, 0, 255),
+], np.uint8)
+label_cache = {}
+
+# "INF FPS: " and the digits of its value as pre-rendered glyph masks
+FPS_COLOR = np.array((0, 255, 0), np.uint8)
+FPS_ORIGIN = (20, 40)
+
+def render_glyph(text, pad=2):
+    # Mask of `text` as cv2.putText(..., FONT_HERSHEY_SIMPLEX, 1.0, thickness=2)
+    # draws it, plus its advance and the baseline row inside the mask
+    thickness = 2
+    (tw, th), base = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 1.0, thickness)
+    mask = np.zeros((th + base + 2 * pad, tw + 2 * pad), np.uint8)
+    cv2.putText(mask, text, (pad, th + pad), cv2.FONT_HERSHEY_SIMPLEX, 1.0, 255, thickness)
+    # getTextSize adds the stroke thickness to the width; putText's pen
+    # advance between characters does not include it
+    return mask[..., None] > 0, tw - thickness, th + pad, pad
+
+fps_prefix = render_glyph("INF FPS: ")
+fps_glyphs = {c: render_glyph(c) for c in "0123456789."}
+
 # ----------------------------
 # Helpers
 # ----------------------------
 def resize_if_needed(frame):
-    if IMG_MAX_WIDTH and frame.shape[1] > IMG_MAX_WIDTH:
-        scale = IMG_MAX_WIDTH / frame.shape[1]
-        frame = cv2.resize(
-            frame,
-            (int(frame.shape[1] * scale), int(frame.shape[0] * scale)),
-            interpolation=cv2.INTER_AREA,
+    # Usually a no-op: the camera is asked for 640x480
+    if not IMG_MAX_WIDTH or frame.shape[1] <= IMG_MAX_WIDTH:
+        return frame
+    scale = IMG_MAX_WIDTH / frame.shape[1]
+    # INTER_LINEAR takes OpenCV's SIMD path; INTER_AREA is scalar for
+    # non-integer scale factors
+    return cv2.resize(
+        frame,
+        (int(frame.shape[1] * scale), int(frame.shape[0] * scale)),
+        interpolation=cv2.INTER_LINEAR,
+    )
+
+def letterbox_geometry(h, w):
+    # Same letterbox as predict(imgsz=IMG_MAX_WIDTH): scale by one factor so
+    # the frame fits an IMG_MAX_WIDTH square, then pad each side up to a
+    # multiple of 32, split evenly. 640x480 -> 960x720 + 8 px top and bottom
+    # = 960x736. Returns (scale, (new_h, new_w), (top, bottom, left, right)).
+    r = IMG_MAX_WIDTH / max(h, w) if IMG_MAX_WIDTH else 1.0
+    new_h, new_w = round(h * r), round(w * r)
+    pad_h = math.ceil(new_h / 32) * 32 - new_h
+    pad_w = math.ceil(new_w / 32) * 32 - new_w
+    return r, (new_h, new_w), (pad_h // 2, pad_h - pad_h // 2,
+                               pad_w // 2, pad_w - pad_w // 2)
+
+def to_hwc(frame):
+    # Camera frames are BGR, or with YUYV a packed buffer that V4L2 may hand
+    # out flat; view those as HxWx2 (Y, U/V interleaved)
+    if frame.ndim == 3:
+        return frame
+    return frame.reshape(CAP_H, CAP_W, 2)
+
+def to_bgr(frame, dst=None):
+    # BGR view of a camera frame for the host-side consumers, into `dst` if given
+    frame = to_hwc(frame)
+    if frame.shape[2] == 2:
+        return cv2.cvtColor(frame, cv2.COLOR_YUV2BGR_YUYV, dst=dst)
+    if dst is None:
+        return frame
+    np.copyto(dst, frame)
+    return dst
+
+def stage_frames(frames, slot):
+    # Copy raw uint8 frames (BGR or YUYV) into `slot` and start their async
+    # upload. Returns the page-locked host copies along with the copy event:
+    # the batch is inferred and annotated one pass later, after the capture
+    # ring may have reused its slots, while this slot is only refilled two
+    # stagings from now.
+    frames = [to_hwc(f) for f in frames]
+    shape = frames[0].shape
+    if pinned_bufs[slot] is None or pinned_bufs[slot].shape[1:] != shape:
+        pinned_bufs[slot] = torch.empty((BATCH, *shape), dtype=torch.uint8, pin_memory=True)
+        device_bufs[slot] = torch.empty((BATCH, *shape), dtype=torch.uint8, device="cuda")
+    n = len(frames)
+    host = pinned_bufs[slot][:n].numpy()
+    np.stack(frames, out=host)
+    with torch.cuda.stream(copy_stream):
+        device_bufs[slot][:n].copy_(pinned_bufs[slot][:n], non_blocking=True)
+        ready = torch.cuda.Event()
+        ready.record()
+    return list(host), ready
+
+def yuyv_to_rgb(x):
+    # (B,H,W,2) packed YUYV -> (B,3,H,W) RGB in 0..1, BT.601 like OpenCV
+    x = x.half()
+    y = (x[..., 0] - 16) * 1.164
+    uv = x[..., 1].unflatten(-1, (-1, 2)) - 128  # (B,H,W/2,[U,V]) per pixel pair
+    u = uv[..., 0].repeat_interleave(2, dim=-1)
+    v = uv[..., 1].repeat_interleave(2, dim=-1)
+    rgb = torch.stack((y + 1.596 * v, y - 0.813 * v - 0.391 * u, y + 2.018 * u), dim=1)
+    return rgb.clamp_(0, 255).div_(255)
+
+if HAVE_TRITON:
+    PREPROCESS_BLOCK = 1024
+
+    @triton.jit
+    def preprocess_kernel(src, dst, HW, YUYV: tl.constexpr, BLOCK: tl.constexpr):
+        # One read of HWC uint8 (BGR or packed YUYV), one write of RGB CHW
+        # scaled to 0..1: channel gather, transpose, cast and normalize fused
+        offs = tl.program_id(0) * BLOCK + tl.arange(0, BLOCK)
+        b = tl.program_id(1)
+        mask = offs < HW
+        if YUYV:
+            base = src + b * HW * 2
+            pair = offs - offs % 2  # first pixel of the Y0 U Y1 V group
+            y = tl.load(base + offs * 2, mask=mask, other=16).to(tl.float32)
+            u = tl.load(base + pair * 2 + 1, mask=mask, other=128).to(tl.float32) - 128.0
+            v = tl.load(base + pair * 2 + 3, mask=mask, other=128).to(tl.float32) - 128.0
+            c = (y - 16.0) * 1.164
+            r = tl.minimum(tl.maximum(c + 1.596 * v, 0.0), 255.0)
+            g = tl.minimum(tl.maximum(c - 0.813 * v - 0.391 * u, 0.0), 255.0)
+            bl = tl.minimum(tl.maximum(c + 2.018 * u, 0.0), 255.0)
+        else:
+            base = src + b * HW * 3
+            bl = tl.load(base + offs * 3, mask=mask, other=0).to(tl.float32)
+            g = tl.load(base + offs * 3 + 1, mask=mask, other=0).to(tl.float32)
+            r = tl.load(base + offs * 3 + 2, mask=mask, other=0).to(tl.float32)
+        out = dst + b * HW * 3
+        ty = dst.dtype.element_ty
+        tl.store(out + offs, (r * (1.0 / 255.0)).to(ty), mask=mask)
+        tl.store(out + HW + offs, (g * (1.0 / 255.0)).to(ty), mask=mask)
+        tl.store(out + 2 * HW + offs, (bl * (1.0 / 255.0)).to(ty), mask=mask)
+
+def fused_preprocess(x, dtype):
+    # (B,H,W,C) uint8 on device -> (B,3,H,W) `dtype` RGB in 0..1, one kernel
+    n, h, w, c = x.shape
+    out = torch.empty((n, 3, h, w), dtype=dtype, device=x.device)
+    grid = (triton.cdiv(h * w, PREPROCESS_BLOCK), n)
+    preprocess_kernel[grid](x, out, h * w, YUYV=(c == 2), BLOCK=PREPROCESS_BLOCK)
+    return out
+
+def gpu_preprocess(x, dtype=torch.float16):
+    # Resize/convert/normalize on device (runs on the current stream)
+    h, w = x.shape[1:3]
+    if HAVE_TRITON:
+        t = fused_preprocess(x, dtype)
+    elif x.shape[3] == 2:
+        t = yuyv_to_rgb(x).to(dtype)
+    else:
+        t = x.permute(0, 3, 1, 2).flip(1).to(dtype).div_(255)  # BGR HWC -> RGB CHW
+    _, size, (top, bottom, left, right) = letterbox_geometry(h, w)
+    if size != (h, w):
+        # "area" only averages when shrinking; interpolate when enlarging
+        mode = "area" if size[1] < w else "bilinear"
+        t = F.interpolate(t, size=size, mode=mode)
+    if top or bottom or left or right:
+        t = F.pad(t, (left, right, top, bottom), value=114 / 255)  # Ultralytics' grey
+    # TensorRT reads the raw NCHW buffer; only the PyTorch model is NHWC
+    if TRT:
+        return t.contiguous()
+    return t.contiguous(memory_format=torch.channels_last)
+
+@torch.inference_mode()
+def infer_gpu(frames, slot, ready):
+    # Feed the prepared tensor straight to the network, skipping
+    # Ultralytics' CPU letterbox/normalize, then run NMS ourselves.
+    with torch.cuda.stream(compute_stream):
+        compute_stream.wait_event(ready)
+        # INT8 engines keep an FP32 input binding
+        dtype = torch.float16 if model.predictor.model.fp16 else torch.float32
+        t = gpu_preprocess(device_bufs[slot][:len(frames)], dtype)
+        if TRT:
+            # The engine executes on its own stream; make sure the input is ready
+            compute_stream.synchronize()
+        preds = model.predictor.inference(t)
+        dets = ops.non_max_suppression(
+            preds, CONF, model.predictor.args.iou, max_det=MAX_DET
+        )
+    compute_stream.synchronize()
+    results = []
+    for det, frame in zip(dets, frames):
+        frame = to_hwc(frame)
+        # Boxes are in letterboxed network-input pixels; undo pad and scale
+        r, _, (top, _, left, _) = letterbox_geometry(*frame.shape[:2])
+        det[:, [0, 2]] = ((det[:, [0, 2]] - left) / r).clamp_(0, frame.shape[1])
+        det[:, [1, 3]] = ((det[:, [1, 3]] - top) / r).clamp_(0, frame.shape[0])
+        results.append(Results(frame, path="", names=model.names, boxes=det))
+    return results
+
+def label_strip(cls_id):
+    strip = label_cache.get(cls_id)
+    if strip is None:
+        text = str(model.names.get(cls_id, cls_id))
+        (tw, th), base = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1)
+        strip = np.empty((th + base + 4, tw + 4, 3), np.uint8)
+        strip[:] = COLORS[cls_id % len(COLORS)]
+        cv2.putText(strip, text, (2, th + 2), cv2.FONT_HERSHEY_SIMPLEX, 0.5,
+                    (255, 255, 255), 1, cv2.LINE_AA)
+        label_cache[cls_id] = strip
+    return strip
+
+def draw_detections(img, boxes):
+    # Draw boxes in place on a BGR frame; much cheaper than Results.plot(),
+    # which allocates a new image and converts colour spaces per call.
+    if len(boxes) == 0:
+        return img
+    h, w = img.shape[:2]
+    xyxy = boxes.xyxy.to(torch.int32).cpu().numpy()
+    np.clip(xyxy, 0, [w - 1, h - 1, w - 1, h - 1], out=xyxy)
+    cls = boxes.cls.to(torch.int32).cpu().numpy()
+    for (x1, y1, x2, y2), c in zip(xyxy.tolist(), cls.tolist()):
+        cv2.rectangle(img, (x1, y1), (x2, y2), COLORS[c % len(COLORS)].tolist(), 2)
+        strip = label_strip(c)
+        y0 = max(y1 - strip.shape[0], 0)
+        sh = min(strip.shape[0], h - y0)
+        sw = min(strip.shape[1], w - x1)
+        img[y0:y0 + sh, x1:x1 + sw] = strip[:sh, :sw]
+    return img
+
+def draw_fps(img, fps):
+    # Composite cached glyphs instead of rasterizing text every frame
+    x, y = FPS_ORIGIN
+    for mask, advance, baseline, pad in [fps_prefix] + [fps_glyphs[c] for c in f"{fps:.1f}"]:
+        y0, x0 = y - baseline, x - pad
+        roi = img[y0:y0 + mask.shape[0], x0:x0 + mask.shape[1]]
+        if roi.shape[:2] != mask.shape[:2]:
+            break  # ran off the frame
+        np.copyto(roi, FPS_COLOR, where=mask)
+        x += advance
+
+class JpegEncoder:
+    # A tjhandle plus an output buffer of tjBufSize() bytes for one frame size.
+    # Handles are not thread-safe, so each thread owns one (see tj_local);
+    # it is released when the thread ends.
+    def __init__(self, w, h):
+        self.size = (w, h)
+        self.handle = tj.tjInitCompress()
+        self.capacity = tj.tjBufSize(w, h, TJSAMP_420)
+        self.buf = (ctypes.c_ubyte * self.capacity)()
+        self.ptr = ctypes.cast(self.buf, ctypes.POINTER(ctypes.c_ubyte))
+
+    def __del__(self):
+        if self.handle:
+            tj.tjDestroy(self.handle)
+
+    def encode(self, img_bgr):
+        h, w = img_bgr.shape[:2]
+        jpeg_size = ctypes.c_ulong(self.capacity)
+        rc = tj.tjCompress2(
+            self.handle, img_bgr.ctypes.data, w, img_bgr.strides[0], h, TJPF_BGR,
+            ctypes.byref(self.ptr), ctypes.byref(jpeg_size),
+            TJSAMP_420, JPEG_QUALITY, TJFLAG_FASTDCT | TJFLAG_NOREALLOC,
         )
-    return frame
+        # The one copy left is into the bytes object handed to the server
+        return ctypes.string_at(self.buf, jpeg_size.value) if rc == 0 else None
 
 def encode_jpeg(img_bgr):
-    if jpeg:
-        try:
-            return jpeg.encode(img_bgr, quality=JPEG_QUALITY)
-        except Exception:
-            pass
-    ok, buf = cv2.imencode(".jpg", img_bgr, [int(cv2.IMWRITE_JPEG_QUALITY), JPEG_QUALITY])
-    return buf.tobytes() if ok else None
-
-def mjpeg_generator(get_frame_fn):
-    frame_interval = 1.0 / max(STREAM_FPS, 1)
+    if tj is not None:
+        img_bgr = np.ascontiguousarray(img_bgr)
+        h, w = img_bgr.shape[:2]
+        enc = getattr(tj_local, "encoder", None)
+        if enc is None or enc.size != (w, h):
+            enc = tj_local.encoder = JpegEncoder(w, h)
+        return enc.encode(img_bgr)
+    try:
+        return jpeg.encode(
+            img_bgr,
+            quality=JPEG_QUALITY,
+            pixel_format=TJPF_BGR,
+            jpeg_subsample=TJSAMP_420,
+            flags=TJFLAG_FASTDCT,
+        )
+    except Exception:
+        return None
+
+def mjpeg_generator(get_seq, get_frame, ready):
+    # Stream each new frame once: wait on `ready` until get_seq() moves on,
+    # then encode get_frame(seq). Start from the current seq: the published
+    # frame may be stale (annotation pauses while nobody watches), so wait
+    # for the next one instead of sending it.
+    frame_interval_ns = 1_000_000_000 // max(STREAM_FPS, 1)
+    last_seq = get_seq()
     while True:
-        frame = get_frame_fn()
-        if frame is None:
-            time.sleep(0.005)
-            continue
-        jpg = encode_jpeg(frame)
+        with ready:
+            if not ready.wait_for(lambda: get_seq() != last_seq, timeout=1.0):
+                continue
+        t_start = time.monotonic_ns()
+        last_seq = get_seq()
+        jpg = encode_jpeg(get_frame(last_seq))
         if jpg is None:
             continue
-        yield (
-            b"--frame\r\n"
-            b"Content-Type: image/jpeg\r\n"
-            b"Content-Length: " + str(len(jpg)).encode() + b"\r\n\r\n" +
-            jpg + b"\r\n"
-        )
-        time.sleep(frame_interval)
+        # One pre-built part per frame: a single join copies the JPEG once and
+        # the server sends it with one write (separate yields would become
+        # separate HTTP chunks / sendall calls under gunicorn)
+        header = (
+            f"--frame\r\nContent-Type: image/jpeg\r\n"
+            f"Content-Length: {len(jpg)}\r\n\r\n"
+        ).encode()
+        yield b"".join((header, jpg, b"\r\n"))
+        # yield returns once the chunk is written, so a slow client has
+        # already used up the interval; only sleep off what is left
+        sleep_left = frame_interval_ns - (time.monotonic_ns() - t_start)
+        if sleep_left > 0:
+            time.sleep(sleep_left / 1e9)
+
+# ThingSpeak helpers
+ts_session = requests.Session()  # keep-alive: no TCP/TLS setup per poll
 
-# ThingSpeak helper
-def get_latest_field(field_num):
+def get_latest_fields():
+    # One request returns every field of the newest feed entry
     try:
-        r = requests.get(TS_URL.format(field_num), timeout=2).json()
-        value = r.get('feeds', [{}])[-1].get(f'field{field_num}', None)
-        return float(value) if value not in (None, "") else 0.0
+        r = ts_session.get(TS_URL, timeout=2).json()
+        feed = (r.get('feeds') or [{}])[-1]
     except Exception:
-        return 0.0
+        feed = {}
+    values = {}
+    for n in TS_FIELDS:
+        value = feed.get(f'field{n}', None)
+        try:
+            values[f'field{n}'] = float(value) if value not in (None, "") else 0.0
+        except ValueError:
+            values[f'field{n}'] = 0.0
+    return values
+
+# The fused kernel is JIT-built on first launch, which needs a host C
+# compiler and a supported GPU; `import triton` succeeding says neither.
+# Launch it once here and keep the torch-ops path if that fails, instead of
+# letting the error kill yolo_loop.
+if GPU and HAVE_TRITON:
+    try:
+        probe = torch.zeros((1, CAP_H, CAP_W, 2 if YUYV else 3), dtype=torch.uint8, device="cuda")
+        fused_preprocess(probe, torch.float16)
+        torch.cuda.synchronize()
+        print("[INFO] Triton fused preprocessing enabled")
+    except Exception as e:
+        HAVE_TRITON = False
+        print(f"[WARN] Triton preprocessing failed ({e}). Using torch ops.")
 
 # ----------------------------
 # Threads
 # ----------------------------
 def capture_loop():
-    global latest_raw
+    global raw_seq
     while not stop_flag:
-        ok, frame = cap.read()
+        slot = raw_seq % RAW_SLOTS  # oldest slot, never the published one
+        ok, frame = cap.read(raw_bufs[slot])
         if not ok or frame is None:
             time.sleep(0.005)
             continue
-        with lock:
-            latest_raw = frame  # drop older frames, keep freshest
+        raw_bufs[slot] = frame
+        raw_seq += 1
+        with raw_ready:
+            raw_ready.notify_all()
+
+def wait_for_frames(last_seq, timeout=1.0):
+    # Block until capture publishes past `last_seq`
+    with raw_ready:
+        raw_ready.wait_for(lambda: raw_seq != last_seq, timeout=timeout)
 
 def yolo_loop():
-    global latest_annot
-    prev_t = time.time()
-    counter = 0
-    min_interval = 1.0 / max(TARGET_INF_FPS, 1)
+    global annot_seq
+    prev_t = time.monotonic_ns()
+    last_seq = 0
+    pending = None  # (frames, slot, ready) uploaded but not yet inferred
+    upload_slot = 0
+    min_interval_ns = 1_000_000_000 // max(TARGET_INF_FPS, 1)
 
     while not stop_flag:
-        now = time.time()
-        sleep_left = min_interval - (now - prev_t)
+        sleep_left = min_interval_ns - (time.monotonic_ns() - prev_t)
         if sleep_left > 0:
-            time.sleep(sleep_left)
-        prev_t = time.time()
-
-        with lock:
-            frame = None if latest_raw is None else latest_raw.copy()
-        if frame is None:
-            time.sleep(0.005)
+            time.sleep(sleep_left / 1e9)
+        prev_t = time.monotonic_ns()
+
+        # Take up to BATCH frames published since the last pass
+        seq = raw_seq
+        n = min(seq - last_seq, BATCH)
+        frames = [raw_bufs[i % RAW_SLOTS] for i in range(seq - n, seq)]
+        last_seq = seq
+
+        if GPU:
+            # Kick off this batch's upload, then infer the previous one while
+            # it copies; with nothing new, flush the pending batch right away.
+            staged = None
+            if frames:
+                snapshots, ready = stage_frames(frames, upload_slot)
+                staged = (snapshots, upload_slot, ready)
+                upload_slot ^= 1
+            batch, pending = pending, staged
+            if batch is None:
+                if not frames:
+                    wait_for_frames(last_seq)
+                continue
+            frames = batch[0]
+        elif not frames:
+            wait_for_frames(last_seq)
             continue
 
-        counter += 1
-        if FRAME_SKIP > 1 and (counter % FRAME_SKIP != 0):
+        t0 = time.monotonic_ns()
+
+        # One forward pass for the whole batch amortizes launch overhead
+        if GPU:
+            results = infer_gpu(*batch)
+        else:
+            # CPU inference outlives a ring slot; work on a private copy
+            frames = [resize_if_needed(f.copy()) for f in frames]
+            with torch.inference_mode():
+                results = model.predict(
+                    frames,
+                    conf=CONF,
+                    imgsz=IMG_MAX_WIDTH if IMG_MAX_WIDTH else None,
+                    half=False,
+                    verbose=False,
+                    max_det=MAX_DET,
+                )
+        inf_fps = len(frames) * 1e9 / max(time.monotonic_ns() - t0, 1)
+
+        # Only the newest frame is streamed, and only if someone is watching
+        if annot_viewers == 0:
             continue
-
-        t0 = time.time()
-        frame = resize_if_needed(frame)
-
-        results = model.predict(
-            frame,
-            conf=CONF,
-            imgsz=IMG_MAX_WIDTH if IMG_MAX_WIDTH else None,
-            half=True if GPU else False,
-            verbose=False,
-            max_det=50,
-        )
-        annotated = results[0].plot()
-
-        inf_fps = 1.0 / max(time.time() - t0, 1e-6)
-        cv2.putText(
-            annotated, f"INF FPS: {inf_fps:.1f}", (20, 40),
-            cv2.FONT_HERSHEY_SIMPLEX, 1.0, (0, 255, 0), 2
-        )
-
-        with lock:
-            latest_annot = annotated
+        slot = annot_seq % 3  # oldest slot, never the published one
+        h, w = to_hwc(frames[-1]).shape[:2]
+        if annot_bufs[slot] is None or annot_bufs[slot].shape != (h, w, 3):
+            annot_bufs[slot] = np.empty((h, w, 3), np.uint8)
+        annotated = to_bgr(frames[-1], dst=annot_bufs[slot])
+        draw_detections(annotated, results[-1].boxes)
+        draw_fps(annotated, inf_fps)
+
+        annot_seq += 1
+        with annot_ready:
+            annot_ready.notify_all()
+
+def sensor_loop():
+    # Poll ThingSpeak in the background so /sensor_data never blocks on HTTP
+    global sensor_json
+    while not stop_flag:
+        sensor_json = json_dumps(get_latest_fields())
+        time.sleep(TS_POLL_INTERVAL)
 
 def start_threads():
     threading.Thread(target=capture_loop, daemon=True).start()
     threading.Thread(target=yolo_loop, daemon=True).start()
+    threading.Thread(target=sensor_loop, daemon=True).start()
 
 # ----------------------------
 # Flask routes
@@ -242,31 +784,39 @@ def favicon():
 
 @app.route("/sensor_data")
 def sensor_data():
-    return jsonify({
-        'field1': get_latest_field(1),
-        'field2': get_latest_field(2),
-        'field3': get_latest_field(3)
-    })
+    return Response(sensor_json, mimetype="application/json")
 
 @app.route("/video_feed")
 def video_feed():
-    def get_annot():
-        with lock:
-            return None if latest_annot is None else latest_annot.copy()
-    return Response(mjpeg_generator(get_annot),
+    def get_annot(seq):
+        return annot_bufs[(seq - 1) % 3]
+    def stream():
+        global annot_viewers
+        with viewers_lock:
+            annot_viewers += 1
+        try:
+            yield from mjpeg_generator(lambda: annot_seq, get_annot, annot_ready)
+        finally:
+            # Runs on GeneratorExit when the client disconnects
+            with viewers_lock:
+                annot_viewers -= 1
+    return Response(stream(),
                     mimetype="multipart/x-mixed-replace; boundary=frame")
 
 @app.route("/video_feed_raw")
 def video_feed_raw():
-    def get_raw():
-        with lock:
-            return None if latest_raw is None else latest_raw.copy()
-    return Response(mjpeg_generator(get_raw),
+    def get_raw(seq):
+        return to_bgr(raw_bufs[(seq - 1) % RAW_SLOTS])
+    return Response(mjpeg_generator(lambda: raw_seq, get_raw, raw_ready),
                     mimetype="multipart/x-mixed-replace; boundary=frame")
 
 # ----------------------------
 # Main
 # ----------------------------
+# Werkzeug's threaded server (one thread per client, no cap). To run under
+# gunicorn with a fixed thread pool instead -- each open MJPEG stream holds
+# one thread, see GUNICORN_THREADS in gunicorn.conf.py:
+#   gunicorn -c gunicorn.conf.py server:app
 if __name__ == "__main__":
     start_threads()
     app.run(host="0.0.0.0", port=5000, threaded=True, use_reloader=False)
\ No newline at end of file